@@ -1,6 +1,7 @@
 import socket
 import tqdm
 import os
+import stat
 import sys
 import ssl
 import logging
@@ -34,6 +35,7 @@ class FileTransferClient:
         self.separator = config['CONNECTION']['SEPARATOR']
         self.downloads_base_dir = config['SETTINGS']['DOWNLOAD_DIR']
         self.certfile = config['CONNECTION']['CERTFILE']
+        self.show_progress = config['SETTINGS'].getboolean('SHOW_PROGRESS', fallback=True)
         self.secure_socket = None
         self.session_id = None
         self.username = None
@@ -214,7 +216,7 @@ class FileTransferClient:
         cmd_value = self.config['COMMANDS'].get(cmd_name, cmd_name)
         request = self.separator.join([cmd_value, str(self.session_id)] + list(args))
         
-        self.secure_socket.sendall(request.encode('utf-8'))
+        self.secure_socket.sendall((request + "\n").encode('utf-8'))
         response = self.secure_socket.recv(self.buffer_size).decode('utf-8').strip()
         return response.split(self.separator)
 
@@ -238,6 +240,15 @@ class FileTransferClient:
         else:
             logging.error(f"Unexpected Server Response: {status}")
     
+    def progress_options(self, file_size):
+        # Throttle redraws to ~1% steps (miniters counts bytes here) / 0.5s;
+        # disabled bars make update() a cheap no-op
+        return {
+            'disable': not self.show_progress,
+            'mininterval': 0.5,
+            'miniters': max(1, file_size // 100),
+        }
+
     def transfer_file(self, file_path, offset=0):
         """
         Streams bytes to the server starting from the given offset.
@@ -253,7 +264,8 @@ class FileTransferClient:
 
                 with tqdm.tqdm(total=file_size, initial=offset, unit="B", 
                             unit_scale=True, unit_divisor=1024, 
-                            desc=f"Uploading {file_name}") as progress:
+                            desc=f"Uploading {file_name}",
+                            **self.progress_options(file_size)) as progress:
                     
                     while True:
                         bytes_read = f.read(self.buffer_size)
@@ -277,14 +289,20 @@ class FileTransferClient:
             return False
     
     def handle_file_upload(self, cmd_key, file_path, recipient_username=None):
-        if not os.path.isfile(file_path):
-            logging.error(f"Upload path not found: {file_path}")
-            return
-        elif file_path == "":
+        if file_path == "":
             logging.error("File path must not be null. Enter a valid file path.")
             return
 
-        file_size = os.path.getsize(file_path)
+        # One stat answers both "is it a regular file" and "how big is it"
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            logging.error(f"Upload path not found: {file_path}")
+            return
+
+        file_size = st.st_size
         file_name = os.path.basename(file_path)
 
         upload_args = [file_name, str(file_size)]
@@ -316,7 +334,8 @@ class FileTransferClient:
             
             with open(full_file_path, mode) as f:
                 with tqdm.tqdm(total=file_size, initial=offset, unit="B", 
-                            unit_scale=True, desc=f"Downloading {os.path.basename(full_file_path)}") as progress:
+                            unit_scale=True, desc=f"Downloading {os.path.basename(full_file_path)}",
+                            **self.progress_options(file_size)) as progress:
                     
                     bytes_received = 0
                     while bytes_received < remaining:
@@ -345,12 +364,15 @@ class FileTransferClient:
             filename, total_size = parts[1], int(parts[2])
             local_path = os.path.join(self.downloads_dir, filename)
             
-            if os.path.exists(local_path):
-                offset = os.path.getsize(local_path)
-                if 0 < offset < total_size:
-                    parts = self.send_command(cmd_raw, file_id, str(offset))
-                    if parts[0] != self.config['RESPONSES']['DOWNLOAD_READY']:
-                        return logging.error("Resume request failed.")
+            # One stat instead of exists() + getsize(); a missing file just means no resume
+            try:
+                offset = os.stat(local_path).st_size
+            except FileNotFoundError:
+                offset = 0
+            if 0 < offset < total_size:
+                parts = self.send_command(cmd_raw, file_id, str(offset))
+                if parts[0] != self.config['RESPONSES']['DOWNLOAD_READY']:
+                    return logging.error("Resume request failed.")
 
             self.receive_file(local_path, total_size, offset)
         else:
@@ -17,7 +17,7 @@ class ClientAuthHandler:
         """Helper to format commands and get server response."""
         try:
             payload = self.separator.join([command_type] + list(args))
-            self.client_socket.sendall(payload.encode())
+            self.client_socket.sendall((payload + "\n").encode())
             
             response = self.client_socket.recv(self.buffer_size).decode().strip()
             return response.split(self.separator)
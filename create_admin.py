@@ -1,6 +1,5 @@
 import os
 import sys
-import bcrypt
 import configparser
 import logging
 from dotenv import load_dotenv
@@ -27,13 +26,21 @@ def main():
     
     db_manager = DatabaseManager(config['DATABASE'])
 
-    admin_username = input("Enter desired admin username: ")
-    admin_password = input("Enter desired admin password: ")
+    try:
+        admin_username = input("Enter desired admin username: ")
+        # Check the name before asking for (and hashing) a password that can't be used
+        if db_manager.get_user_id(admin_username) is not None:
+            logging.error(f"Failed to create admin user '{admin_username}'. It already exists.")
+            return
 
-    if db_manager.create_user(admin_username, admin_password, role='admin'):
-        logging.info(f"Admin user '{admin_username}' created successfully!")
-    else:
-        logging.error(f"Failed to create admin user '{admin_username}'. It might already exist.")
+        admin_password = input("Enter desired admin password: ")
+
+        if db_manager.create_user(admin_username, admin_password, role='admin'):
+            logging.info(f"Admin user '{admin_username}' created successfully!")
+        else:
+            logging.error(f"Failed to create admin user '{admin_username}'. It might already exist.")
+    finally:
+        db_manager.close_pool()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,9 +2,13 @@ import socket
 import ssl
 import os
 import sys
-import threading
 import configparser
 import logging
+import logging.handlers
+import queue
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 from thread_functions import ClientHandler
@@ -27,17 +31,63 @@ def setup_logging(config):
 
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
-    root_logger.addHandler(console_handler)
+    output_handlers = [console_handler]
 
     log_file = config['LOGGING'].get('SERVER_LOG_FILE')
+    file_error = None
     if log_file:
         try:
             file_handler = logging.FileHandler(log_file)
             file_handler.setFormatter(formatter)
-            root_logger.addHandler(file_handler)
-            logging.info(f"Logging configured to write to file: {log_file}")
+            output_handlers.append(file_handler)
         except Exception as e:
-            logging.error(f"Failed to set up file logging: {e}")
+            file_error = e
+
+    # Handler I/O (stdout/file writes) happens on the listener thread. QueueHandler.prepare() still
+    # formats the message (and any traceback) on the calling thread before enqueueing it
+    log_queue = queue.SimpleQueue()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *output_handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    if file_error:
+        logging.error(f"Failed to set up file logging: {file_error}")
+    elif log_file:
+        logging.info(f"Logging configured to write to file: {log_file}")
+
+def serve_client(context, raw_socket, address, config, auth_handler, db_manager, handshake_timeout, idle_timeout, slots):
+    # Runs on a pool worker: the TLS handshake happens here rather than inside accept()
+    try:
+        try:
+            raw_socket.settimeout(handshake_timeout)
+            client_socket = context.wrap_socket(raw_socket, server_side=True)
+            # An idle session would otherwise hold this worker until the client quits
+            client_socket.settimeout(idle_timeout or None)
+        except (ssl.SSLError, OSError) as e:
+            logging.error(f"TLS handshake with {address[0]}:{address[1]} failed: {e}")
+            raw_socket.close()
+            return
+        ClientHandler(client_socket, address, config, auth_handler, db_manager).run()
+    except Exception:
+        # Nobody reads the Future, so anything not logged here would vanish
+        logging.exception(f"Unhandled error serving {address[0]}:{address[1]}")
+    finally:
+        slots.release()
+
+def refuse_client(context, raw_socket, address, config, handshake_timeout, refusals):
+    # Runs on its own short-lived thread: complete the handshake so the client gets a
+    # protocol-level "busy" reply instead of a bare disconnect
+    try:
+        raw_socket.settimeout(handshake_timeout)
+        with context.wrap_socket(raw_socket, server_side=True) as client_socket:
+            busy = f"{config['RESPONSES']['ERROR']}{config['SERVER']['SEPARATOR']}Server busy, try again later."
+            client_socket.sendall(busy.encode('utf-8'))
+    except (ssl.SSLError, OSError) as e:
+        logging.debug(f"Busy reply to {address[0]}:{address[1]} failed: {e}")
+    finally:
+        raw_socket.close()
+        refusals.release()
 
 def read_config(path='server_config.ini'):
     # read configs
@@ -77,8 +127,7 @@ def main():
 
     try:
         db_manager = DatabaseManager(db_config)
-        db_manager.create_user_table_if_not_exists()
-        db_manager.create_files_table_if_not_exists()
+        db_manager.ensure_schema()
         auth_handler = ServerAuthHandler(db_manager, config)
     except Exception as e:
         logging.critical(f"Error initializing database or auth handler: {e}", exc_info=True)
@@ -93,30 +142,61 @@ def main():
         logging.critical(f"SSL certificate or key file not found: {certfile}, {keyfile}")
         sys.exit(1)
 
+    # Bounded worker pool instead of one fresh thread per connection. A logged-in session holds
+    # its worker until QUIT or IDLE_TIMEOUT, so this is the number of concurrent sessions,
+    # not a CPU-bound pool size; the threads spend nearly all their time blocked on I/O
+    max_workers = server_config.getint('MAX_WORKERS', fallback=128)
+    handshake_timeout = server_config.getfloat('HANDSHAKE_TIMEOUT', fallback=10.0)
+    idle_timeout = server_config.getfloat('IDLE_TIMEOUT', fallback=120.0)
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='client')
+    # One slot per worker: a connection is only accepted into the pool if a worker is free,
+    # rather than waiting in the executor queue with no handshake
+    slots = threading.BoundedSemaphore(max_workers)
+    # Caps the threads sending "Server busy" replies; past that, overflow is simply closed
+    refusals = threading.BoundedSemaphore(8)
+
     try:
         context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+        # Keep session tickets on so reconnecting clients can resume instead of a full handshake
+        context.options &= ~ssl.OP_NO_TICKET
 
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.bind((host, port))
-        server_socket.listen(5)
-        logging.info(f"Listening on {host}:{port}")
+        # Handshakes happen off the accept loop, so a large backlog only covers accept() latency
+        server_socket.listen(socket.SOMAXCONN)
+        logging.info(f"Listening on {host}:{port} with {max_workers} worker threads")
 
-        with context.wrap_socket(server_socket, server_side=True) as secure_socket:
+        # Accept plain TCP and hand the socket straight to a worker, so one slow or stalled
+        # handshake can no longer hold up every other incoming connection
+        with server_socket:
             while True:
                 try:
-                    client_socket, address = secure_socket.accept()
+                    client_socket, address = server_socket.accept()
+                    if not slots.acquire(blocking=False):
+                        logging.warning(f"[-] All {max_workers} workers busy; refusing {address[0]}:{address[1]}")
+                        if refusals.acquire(blocking=False):
+                            threading.Thread(target=refuse_client, daemon=True,
+                                             args=(context, client_socket, address, config,
+                                                   handshake_timeout, refusals)).start()
+                        else:
+                            client_socket.close()
+                        continue
                     logging.info(f"[+] Accepted connection from {address[0]}:{address[1]}")
-                    client_thread = ClientHandler(client_socket, address, config, auth_handler, db_manager)
-                    client_thread.start()
-                except ssl.SSLError as e:
-                    logging.error(f"SSL error during client connection: {e}")
+                    try:
+                        executor.submit(serve_client, context, client_socket, address, config,
+                                        auth_handler, db_manager, handshake_timeout, idle_timeout, slots)
+                    except Exception:
+                        slots.release()
+                        client_socket.close()
+                        raise
                 except Exception as e:
                     logging.error(f"An unexpected error occurred: {e}", exc_info=True)
 
     except Exception as e:
         logging.critical(f"Server application error: {e}", exc_info=True)
     finally:
+        executor.shutdown(wait=False, cancel_futures=True)
         if 'db_manager' in locals():
             db_manager.close_pool()
         if 'server_socket' in locals() and server_socket:
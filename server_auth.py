@@ -1,10 +1,23 @@
-import bcrypt
+import os
 import uuid
 import logging
 import threading
+import time
 from user_management import DatabaseManager
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
+class Session:
+    """One logged-in session; __slots__ keeps each entry in the session table small."""
+    __slots__ = ('username', 'role', 'user_id', 'expires')
+
+    def __init__(self, username, role, user_id, expires):
+        self.username = username
+        self.role = role
+        self.user_id = user_id
+        self.expires = expires
+
 class ServerAuthHandler:
     def __init__(self, db_manager: DatabaseManager, config):
         self.db_manager = db_manager
@@ -25,43 +38,51 @@ class ServerAuthHandler:
         self.PERMISSION_DENIED_RESPONSE = self.config['RESPONSES']['PERMISSION_DENIED']
         self.ERROR_RESPONSE = self.config['RESPONSES']['ERROR']
         self.separator = self.config['SERVER']['SEPARATOR']
+        # Idle timeout in seconds; 0 keeps sessions until logout
+        self.session_timeout = self.config['SERVER'].getfloat('SESSION_TIMEOUT', fallback=0)
+        # Sessions whose client vanished are never looked up again, so logins sweep the table
+        # (at most once per SESSION_TIMEOUT) to keep it bounded
+        self.next_sweep = time.monotonic() + self.session_timeout
+
+    @staticmethod
+    def is_valid_username(username):
+        # The name becomes a directory under UPLOAD_DIR, so it must be a single plain path component
+        if username in ('.', '..') or '\0' in username:
+            return False
+        return not any(sep and sep in username for sep in ('/', '\\', os.sep, os.altsep))
 
     def register_user(self, username, password):
         """Registers a new user via the db_manager."""
         try:
-            if not username or not password:
-                return self.REGISTER_FAILED_RESPONSE
-            
-            if self.db_manager.get_user_record(username=username):
-                logging.warning(f"Registration failed: User '{username}' already exists.")
+            if not username or not password or not self.is_valid_username(username):
                 return self.REGISTER_FAILED_RESPONSE
             
+            # create_user rejects taken names before spending a hash on them
             if self.db_manager.create_user(username, password):
-                logging.info(f"User '{username}' registered successfully.")
+                logger.info("User '%s' registered successfully.", username)
                 return self.REGISTER_SUCCESS_RESPONSE
             return self.REGISTER_FAILED_RESPONSE
         except Exception as e:
-            logging.error(f"Registration Error: {e}")
+            logger.error("Registration Error: %s", e)
             return f"{self.ERROR_RESPONSE}{self.separator}{str(e)}"
 
     def login_user(self, username, password):
         """Authenticates user and returns the full 5-part success string."""
         try:
-            user = self.db_manager.get_user_record(username=username)
+            user = self.db_manager.get_user_record(username=username, with_password=True)
             
-            if user and bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
+            if not user:
+                self.db_manager.verify_dummy(password)
+            elif self.db_manager.verify_and_upgrade(user, password):
                 session_id = str(uuid.uuid4())
                 
                 with self.session_lock:
-                    self.sessions[session_id] = {
-                        'username': username, 
-                        'role': user['role'], 
-                        'user_id': user['id']
-                    }
+                    self._sweep_expired()
+                    self.sessions[session_id] = Session(username, user['role'], user['id'], self._session_deadline())
                 
-                self.db_manager.update_user_record(user['id'], session_id=session_id)
+                self.db_manager.set_user_session(user['id'], session_id)
 
-                logging.info(f"User '{username}' (ID: {user['id']}) logged in.")
+                logger.info("User '%s' (ID: %s) logged in.", username, user['id'])
                 
                 return (f"{self.LOGIN_SUCCESS_RESPONSE}{self.separator}"
                         f"{session_id}{self.separator}"
@@ -69,11 +90,11 @@ class ServerAuthHandler:
                         f"{user['role']}{self.separator}"
                         f"{user['id']}")
             
-            logging.warning(f"Failed login attempt for username: {username}")
+            logger.warning("Failed login attempt for username: %s", username)
             return self.LOGIN_FAILED_RESPONSE
 
         except Exception as e:
-            logging.error(f"Login Error: {e}")
+            logger.error("Login Error: %s", e)
             return self.LOGIN_FAILED_RESPONSE
 
     def logout_user(self, session_id):
@@ -82,17 +103,41 @@ class ServerAuthHandler:
             session_data = self.sessions.pop(session_id, None)
         
         if session_data:
-            self.db_manager.update_user_record(session_data['user_id'], session_id=None)
-            logging.info(f"User '{session_data['username']}' logged out.")
+            self.db_manager.set_user_session(session_data.user_id, None)
+            logger.info("User '%s' logged out.", session_data.username)
             return self.LOGOUT_SUCCESS_RESPONSE
         return self.INVALID_SESSION_RESPONSE
 
-    def is_valid_session(self, session_id):
-        """Check if session exists in memory."""
-        with self.session_lock:
-            return session_id in self.sessions
+    def _session_deadline(self):
+        return time.monotonic() + self.session_timeout if self.session_timeout > 0 else None
+
+    def _live_session(self, session_id):
+        """Dict lookup plus idle-expiry check; caller holds session_lock."""
+        session_data = self.sessions.get(session_id)
+        if session_data is None:
+            return None
+        expires = session_data.expires
+        if expires is not None:
+            if time.monotonic() >= expires:
+                del self.sessions[session_id]
+                return None
+            session_data.expires = self._session_deadline()
+        return session_data
+
+    def _sweep_expired(self):
+        """Drops every idle-expired session; caller holds session_lock."""
+        now = time.monotonic()
+        if self.session_timeout <= 0 or now < self.next_sweep:
+            return
+        self.next_sweep = now + self.session_timeout
+        expired = [sid for sid, session in self.sessions.items()
+                   if session.expires is not None and now >= session.expires]
+        for sid in expired:
+            del self.sessions[sid]
+        if expired:
+            logger.info("Expired %s idle session(s).", len(expired))
 
     def get_session_data(self, session_id):
-        """Returns the full session dict: username, role, user_id."""
+        """Returns the Session (username, role, user_id) or None."""
         with self.session_lock:
-            return self.sessions.get(session_id)
\ No newline at end of file
+            return self._live_session(session_id)
\ No newline at end of file
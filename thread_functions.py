@@ -1,121 +1,273 @@
-import threading
 import socket
+import ssl
+import mmap
 import shutil
+import threading
 import os
+import stat
+import time
 import logging
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 from server_auth import ServerAuthHandler
 from user_management import DatabaseManager
 
-class ClientHandler(threading.Thread):
+# _IOW(0x94, 9, int); the fcntl module only exports FICLONE from Python 3.12
+FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+
+logger = logging.getLogger(__name__)
+
+class ClientHandler:
+    # Runs one client session; submitted to the server's worker pool via run()
+
+    # The public listing is the same for every client, so it is shared across handlers
+    # and invalidated by DatabaseManager.files_version
+    public_list_cache = {'version': None, 'payload': None}
+    public_list_lock = threading.Lock()
+
     def __init__(self, client_socket: socket.socket, address: tuple, server_config: dict, auth_handler: ServerAuthHandler, db_manager: DatabaseManager):
-        threading.Thread.__init__(self)
         self.client_socket = client_socket
         self.address = address
         self.config = server_config
         self.auth_handler = auth_handler
         self.db_manager = db_manager
         
-        # Directory mapping from config
-        self.upload_dir = self.config['SERVER']['UPLOAD_DIR']
-        self.public_files_dir = self.config['SERVER']['PUBLIC_FILES_DIR']
-        self.shared_uploads_dir = self.config['SERVER']['SHARED_UPLOADS_DIR']
-        self.buffer_size = self.config['SERVER'].getint('BUFFER_SIZE')
-        self.separator = self.config['SERVER']['SEPARATOR']
-        
         # User Session State
+        self.session_checked_until = 0.0
         self.session_id = None
         self.username = None
+        self.user_upload_dir = None
         self.user_role = None
         self.user_id = None
+
+        logger.debug("[%s] Client handler initialized.", self.address)
+
+    def load_settings(self):
+        # Called from run() so config parsing, buffer allocation and socket tuning
+        # happen on the worker thread rather than the accept loop
+
+        # Directory mapping from config
+        # Made absolute once here so per-request containment checks are pure string work
+        self.upload_dir = os.path.abspath(self.config['SERVER']['UPLOAD_DIR'])
+        self.public_files_dir = os.path.abspath(self.config['SERVER']['PUBLIC_FILES_DIR'])
+        self.shared_uploads_dir = os.path.abspath(self.config['SERVER']['SHARED_UPLOADS_DIR'])
+        self.buffer_size = self.config['SERVER'].getint('BUFFER_SIZE')
+        self.separator = self.config['SERVER']['SEPARATOR']
+        self.session_check_ttl = self.config['SERVER'].getfloat('SESSION_CHECK_TTL', fallback=2.0)
+        self.socket_buffer_size = self.config['SERVER'].getint('SOCKET_BUFFER_SIZE', fallback=0)
+        self.max_file_size = self.config['SERVER'].getint('MAX_FILE_SIZE', fallback=10 * 1024**3)
+        self.use_hardlinks = self.config['SERVER'].getboolean('USE_HARDLINKS', fallback=False)
+        self.drop_cache_min_size = self.config['SERVER'].getint('DROP_CACHE_MIN_SIZE', fallback=64 * 1024**2)
+
+        # Reused for every command and upload read instead of allocating a fresh bytes object per recv
+        self.recv_buffer = bytearray(self.buffer_size)
+        self.recv_view = memoryview(self.recv_buffer)
+
+        # Commands are '\n'-terminated; bytes read past the current frame wait here
+        self.rx = bytearray()
+        self.rx_scanned = 0
+
+        # Snapshot command/response strings into plain dicts so the command loop
+        # doesn't go through ConfigParser section lookups on every request
+        self.cmds = {key.upper(): value for key, value in self.config['COMMANDS'].items()}
+        self.response = {key.upper(): value for key, value in self.config['RESPONSES'].items()}
+
+        # Wire forms of the constant strings, encoded once per connection
+        self.separator_b = self.separator.encode('utf-8')
+        self.response_b = {key: value.encode('utf-8') for key, value in self.response.items()}
+        self.list_empty_responses = {
+            self.cmds[cmd_key]: self.response_b[response_key]
+            for cmd_key, response_key in (('LIST_PUBLIC', 'NO_FILES_PUBLIC'),
+                                          ('LIST_SHARED', 'NO_FILES_SHARED'),
+                                          ('LIST_PRIVATE', 'NO_FILES_PRIVATE'))
+            if response_key in self.response_b
+        }
         
-        # Pre-cache command/response dictionaries for cleaner access
-        self.cmds = self.config['COMMANDS']
-        self.response = self.config['RESPONSES']
-        
-        logging.info(f"[{self.address}] Client handler initialized.")
+        self.configure_socket()
 
     def run(self):
         try:
+            self.load_settings()
+            if logger.isEnabledFor(logging.DEBUG) and isinstance(self.client_socket, ssl.SSLSocket):
+                logger.debug("[%s] TLS %s, session reused: %s", self.address, self.client_socket.version(), self.client_socket.session_reused)
             self.handle_client_connection()
         except (socket.error, ConnectionResetError):
-            logging.warning(f"[{self.address}] Connection lost.")
+            logger.warning("[%s] Connection lost.", self.address)
         finally:
             self.cleanup()
 
+    def build_dispatch_table(self):
+        # command -> (minimum field count, needs a valid session, handler)
+        cmds = self.cmds
+        table = {
+            cmds['REGISTER']: (3, False, self.do_register),
+            cmds['LOGIN']: (3, False, self.do_login),
+            cmds['UPLOAD_PRIVATE']: (4, True, self.do_upload),
+            cmds['UPLOAD_PUBLIC']: (4, True, self.do_upload),
+            cmds['UPLOAD_FOR_SHARING']: (5, True, self.do_upload),
+            cmds.get('DELETE_FILE', 'DELETE_FILE'): (3, True, self.do_delete),
+            cmds['ADMIN_DELETE_FILE']: (3, True, self.do_delete),
+            cmds['MAKE_PUBLIC_USER']: (3, True, self.do_status_change),
+            cmds['MAKE_SHARED_USER']: (3, True, self.do_status_change),
+            cmds['LOGOUT']: (2, True, self.do_logout),
+            cmds['QUIT']: (2, True, self.do_logout),
+        }
+        for key in ('LIST_PRIVATE', 'LIST_PUBLIC', 'LIST_SHARED'):
+            table[cmds[key]] = (2, True, self.do_list)
+        for key in ('DOWNLOAD_PRIVATE', 'DOWNLOAD_SHARED', 'DOWNLOAD_PUBLIC'):
+            table[cmds[key]] = (3, True, self.do_download)
+        return table
+
     def handle_client_connection(self):
+        dispatch = self.build_dispatch_table()
         while True:
             try:
-                data = self.client_socket.recv(self.buffer_size).decode('utf-8').strip()
-                if not data: break
+                data = self.read_command()
+                if data is None: break
+                data = data.strip()
+                if not data: continue
                 
                 parts = data.split(self.separator)
                 command = parts[0]
 
-                if command == self.cmds['REGISTER']:
-                    self.send_response(self.auth_handler.register_user(parts[1], parts[2]))
-                    continue
-                
-                if command == self.cmds['LOGIN']:
-                    response = self.auth_handler.login_user(parts[1], parts[2])
-                    if response.startswith(self.response['LOGIN_SUCCESS']):
-                        _, self.session_id, self.username, self.user_role, self.user_id = response.split(self.separator)
-                        os.makedirs(os.path.join(self.upload_dir, self.username), exist_ok=True)
-                    self.send_response(response)
+                entry = dispatch.get(command)
+                if entry is None:
+                    logger.warning("Unknown command received: %s", command)
+                    self.send_response(self.response_b['UNKNOWN_COMMAND'])
                     continue
 
-                session_id = parts[1] if len(parts) > 1 else None
+                min_parts, needs_session, handler = entry
+                if len(parts) < min_parts:
+                    self.send_error("Malformed command.")
+                    continue
 
-                if not session_id or not self.auth_handler.is_valid_session(session_id):
-                    self.send_response(self.response['INVALID_SESSION'])
+                if needs_session and not self.bind_session(parts[1]):
+                    self.send_response(self.response_b['INVALID_SESSION'])
                     continue
 
-                session_data = self.auth_handler.get_session_data(session_id)
-                self.session_id = session_id
-                self.username = session_data['username']
-                self.user_role = session_data['role']
-                self.user_id = session_data['user_id']
-                
-                
-                # LISTING
-                if command in [self.cmds['LIST_PRIVATE'], self.cmds['LIST_PUBLIC'], self.cmds['LIST_SHARED']]:
-                    self.handle_file_list(command)
-
-                # DOWNLOAD
-                elif command in [self.cmds['DOWNLOAD_PRIVATE'], self.cmds['DOWNLOAD_SHARED'], self.cmds['DOWNLOAD_PUBLIC']]:
-                    self.handle_file_download(parts[2], parts)
-
-                # UPLOAD
-                elif command in [self.cmds['UPLOAD_PRIVATE'], self.cmds['UPLOAD_PUBLIC'], self.cmds['UPLOAD_FOR_SHARING']]:
-                    recipient = parts[2] if command == self.cmds['UPLOAD_FOR_SHARING'] else None
-                    self.handle_file_upload(command, parts, recipient)
-
-                # DELETE
-                elif command in [self.cmds.get('DELETE_FILE', 'DELETE_FILE'), self.cmds['ADMIN_DELETE_FILE']]:
-                    is_admin_req = (command == self.cmds['ADMIN_DELETE_FILE'])
-                    self.handle_file_delete(parts[2], is_admin_req)
-
-                # SHARE / VISIBILITY
-                elif command in [self.cmds['MAKE_PUBLIC_USER'], self.cmds['MAKE_SHARED_USER']]:
-                    target = parts[3] if len(parts) > 3 else None
-                    self.handle_file_status_change(parts[2], command, target)
-
-                # LOGOUT / QUIT
-                elif command == self.cmds['LOGOUT'] or command == self.cmds['QUIT']:
-                    self.auth_handler.logout_user(self.session_id)
-                    if command == self.cmds['LOGOUT']:
-                        self.send_response(self.response['LOGOUT_SUCCESS'])
+                # Handlers return True when the session should end
+                if handler(command, parts):
                     break
-                else:
-                    logging.warning(f"Unknown command received: {command}")
-                    self.send_response(f"{self.response['UNKNOWN_COMMAND']}")
                 
             except Exception as e:
-                logging.error(f"Command Error: {e}", exc_info=True)
-                self.send_response(f"{self.response['ERROR']}{self.separator}Internal server error.")
+                logger.error("Command Error: %s", e, exc_info=True)
+                self.send_error("Internal server error.")
+
+    def read_command(self):
+        # Returns the next command frame, or None when the peer closes or overruns the buffer
+        rx = self.rx
+        while True:
+            end = rx.find(b"\n", self.rx_scanned)
+            if end >= 0:
+                frame = bytes(rx[:end])
+                del rx[:end + 1]
+                self.rx_scanned = 0
+                return str(frame, 'utf-8')
+
+            if len(rx) >= self.buffer_size:
+                logger.warning("[%s] Command exceeded %s bytes without a terminator.", self.address, self.buffer_size)
+                return None
+
+            # Resume the newline scan where this one stopped
+            self.rx_scanned = len(rx)
+            try:
+                received = self.client_socket.recv_into(self.recv_view)
+            except socket.timeout:
+                logger.info("[%s] Idle timeout; closing connection.", self.address)
+                return None
+            if not received:
+                return None
+            self.set_quickack()
+            rx += self.recv_view[:received]
+
+    def bind_session(self, session_id):
+        if not session_id:
+            return False
+
+        # Same token validated moments ago on this connection: skip the shared session table
+        if session_id == self.session_id and time.monotonic() < self.session_checked_until:
+            return True
+
+        session_data = self.auth_handler.get_session_data(session_id)
+        if not session_data:
+            return False
+
+        self.session_id = session_id
+        if session_data.username != self.username or self.user_upload_dir is None:
+            self.user_upload_dir = self.user_dir(session_data.username)
+        self.username = session_data.username
+        self.user_role = session_data.role
+        self.user_id = session_data.user_id
+        self.session_checked_until = time.monotonic() + self.session_check_ttl
+        return True
+
+    # --- COMMAND HANDLERS ---
+
+    def do_register(self, command, parts):
+        self.send_response(self.auth_handler.register_user(parts[1], parts[2]))
+
+    def do_login(self, command, parts):
+        # Check the storage path before login_user creates a session for it
+        try:
+            upload_dir = self.user_dir(parts[1])
+        except ValueError:
+            return self.send_response(self.response_b['LOGIN_FAILED'])
+
+        response = self.auth_handler.login_user(parts[1], parts[2])
+        fields = response.split(self.separator, 4)
+        if fields[0] == self.response['LOGIN_SUCCESS']:
+            _, self.session_id, self.username, self.user_role, self.user_id = fields
+            self.user_upload_dir = upload_dir
+            os.makedirs(self.user_upload_dir, exist_ok=True)
+        self.send_response(response)
+
+    def do_list(self, command, parts):
+        self.handle_file_list(command)
+
+    def do_download(self, command, parts):
+        self.handle_file_download(parts[2], parts)
+
+    def do_upload(self, command, parts):
+        recipient = parts[2] if command == self.cmds['UPLOAD_FOR_SHARING'] else None
+        self.handle_file_upload(command, parts, recipient)
+
+    def do_delete(self, command, parts):
+        is_admin_req = (command == self.cmds['ADMIN_DELETE_FILE'])
+        self.handle_file_delete(parts[2], is_admin_req)
+
+    def do_status_change(self, command, parts):
+        target = parts[3] if len(parts) > 3 else None
+        self.handle_file_status_change(parts[2], command, target)
+
+    def do_logout(self, command, parts):
+        self.auth_handler.logout_user(self.session_id)
+        self.session_checked_until = 0.0
+        if command == self.cmds['LOGOUT']:
+            self.send_response(self.response_b['LOGOUT_SUCCESS'])
+        return True
 
     # --- GENERIC IMPLEMENTATIONS USING CONFIG ---
 
     def handle_file_list(self, cmd):
+        if cmd != self.cmds['LIST_PUBLIC']:
+            return self.send_response(self.build_list_payload(cmd))
+
+        # Version is read before querying, so a write racing the query only causes a rebuild next time
+        version = self.db_manager.files_version
+        with ClientHandler.public_list_lock:
+            cache = ClientHandler.public_list_cache
+            payload = cache['payload'] if cache['version'] == version else None
+
+        if payload is None:
+            payload = self.build_list_payload(cmd)
+            with ClientHandler.public_list_lock:
+                ClientHandler.public_list_cache = {'version': version, 'payload': payload}
+
+        self.send_response(payload)
+
+    def build_list_payload(self, cmd):
         query_map = {
             self.cmds['LIST_PUBLIC']: {'is_public': True},
             self.cmds['LIST_SHARED']: {'recipient_id': self.user_id, 'is_public': False},
@@ -130,195 +282,408 @@ class ClientHandler(threading.Thread):
         files = self.db_manager.get_files(**filters)
 
         if not files:
-            if 'PUBLIC' in cmd:
-                response_key = 'NO_FILES_PUBLIC'
-            elif 'SHARED' in cmd:
-                response_key = 'NO_FILES_SHARED'
-            else:
-                response_key = 'NO_FILES_PRIVATE'
-                
-            self.send_response(self.response.get(response_key, "LIST_EMPTY"))
-        else:
-            flat_list = []
-            for f in files:
-                flat_list.append(str(f['file_id']))
-                flat_list.append(f['file_name'])
-            
-            data_string = self.separator.join(flat_list)
-            
-            self.send_response(f"{self.response['LIST_SUCCESS']}{self.separator}{data_string}")
+            return self.list_empty_responses.get(cmd, b"LIST_EMPTY")
+
+        # Encode straight into one buffer instead of joining and re-encoding a str
+        sep_b = self.separator_b
+        payload = bytearray(self.response_b['LIST_SUCCESS'])
+        for file_id, file_name, *_ in files:
+            payload += sep_b
+            payload += str(file_id).encode('utf-8')
+            payload += sep_b
+            payload += file_name.encode('utf-8')
+
+        return bytes(payload)
     
     def handle_file_upload(self, cmd, parts, recipient_username=None):
         try:
             file_name = os.path.basename(parts[-2])
             file_size = int(parts[-1])
+            if file_size < 0 or file_size > self.max_file_size:
+                return self.send_error("File size out of range.")
             
             is_public = (cmd == self.cmds['UPLOAD_PUBLIC'])
             recipient_id = None
             if recipient_username:
-                recip_record = self.db_manager.get_user_record(username=recipient_username)
-                recipient_id = recip_record['id'] if recip_record else None
+                recipient_id = self.db_manager.get_user_id(recipient_username)
 
             temp_record = {'file_name': file_name, 'is_public': is_public, 'recipient_id': recipient_id, 'owner_id': self.user_id}
             dest_path = self.resolve_path(temp_record)
             os.makedirs(os.path.dirname(dest_path), exist_ok=True)
 
-            offset = 0
-            if os.path.exists(dest_path):
-                offset = os.path.getsize(dest_path)
-                if offset >= file_size:
-                    offset = 0 
-
-            self.send_response(f"{self.response['READY_FOR_DATA']}{self.separator}{offset}")
+            # One stat call gives both existence and the resume offset
+            try:
+                st = os.stat(dest_path)
+                offset = st.st_size
+            except FileNotFoundError:
+                st = None
+                offset = 0
+            if offset >= file_size:
+                offset = 0
+            # A linked file is a completed share, never a partial upload: give the
+            # new upload its own inode instead of writing through the link
+            if st and st.st_nlink > 1:
+                os.unlink(dest_path)
+                offset = 0
+
+            self.send_response(b"%s%s%d" % (self.response_b['READY_FOR_DATA'], self.separator_b, offset))
             
             mode = "ab" if offset > 0 else "wb"
             with open(dest_path, mode) as f:
+                self.advise_file(f, offset, 'POSIX_FADV_SEQUENTIAL')
                 received = offset
+                # Anything the client sent behind the command frame is file data
+                if self.rx:
+                    pending = self.rx[:file_size - received]
+                    f.write(pending)
+                    received += len(pending)
+                    del self.rx[:len(pending)]
+                # TLS hands back at most one record (~16 KiB) per recv_into, so fill the whole
+                # buffer across several reads and issue one write per BUFFER_SIZE
+                view = self.recv_view
                 while received < file_size:
-                    chunk = self.client_socket.recv(min(self.buffer_size, file_size - received))
-                    if not chunk: break
-                    f.write(chunk)
-                    received += len(chunk)
+                    want = min(self.buffer_size, file_size - received)
+                    filled = 0
+                    while filled < want:
+                        n = self.client_socket.recv_into(view[filled:want])
+                        if not n: break
+                        filled += n
+                    if filled:
+                        f.write(view[:filled])
+                        received += filled
+                    if filled < want: break
+
+                # Large one-off transfers shouldn't push hot files out of the page cache;
+                # DONTNEED starts writeback of the dirty pages and drops the clean ones
+                if file_size >= self.drop_cache_min_size:
+                    f.flush()
+                    self.advise_file(f, 0, 'POSIX_FADV_DONTNEED')
 
             if received == file_size:
                 existing = self.db_manager.get_file_record(file_name=file_name, owner_id=self.user_id)
                 if existing:
-                    self.send_response(self.response['UPLOAD_SUCCESS'])
+                    self.send_response(self.response_b['UPLOAD_SUCCESS'])
                 else:
                     f_record = self.db_manager.add_file_record(self.user_id, file_name, file_size, is_public, recipient_id)
                     if f_record:    
-                        self.send_response(self.response['UPLOAD_SUCCESS'])
+                        self.send_response(self.response_b['UPLOAD_SUCCESS'])
                     else:
-                        self.send_response(self.response['UPLOAD_FAILED'])
+                        self.send_response(self.response_b['UPLOAD_FAILED'])
             else:
-                logging.warning(f"Transfer interrupted. Partial file saved: {dest_path} ({received}/{file_size})")
-                self.send_response(self.response['UPLOAD_FAILED'])
+                logger.warning("Transfer interrupted. Partial file saved: %s (%s/%s)", dest_path, received, file_size)
+                self.send_response(self.response_b['UPLOAD_FAILED'])
                 
         except Exception as e:
-            self.send_response(f"{self.response['ERROR']}{self.separator}{str(e)}")
+            self.send_error(str(e))
 
     def handle_file_download(self, file_id, parts):
         f = self.db_manager.get_file_record(file_id=file_id)
         if not f:
-            return self.send_response(self.response['FILE_NOT_FOUND'])
+            return self.send_response(self.response_b['FILE_NOT_FOUND'])
 
         can_access = (f['is_public'] or f['owner_id'] == self.user_id or 
                     f['recipient_id'] == self.user_id or self.user_role == 'admin')
 
         if not can_access:
-            return self.send_response(self.response['PERMISSION_DENIED'])
+            return self.send_response(self.response_b['PERMISSION_DENIED'])
 
+        # parts: command, session_id, file_id, [offset]
         try:
-            requested_offset = int(parts[1]) if len(parts) > 1 else 0
+            requested_offset = int(parts[3]) if len(parts) > 3 else 0
         except ValueError:
             requested_offset = 0
 
         path = self.resolve_path(f)
-        if os.path.exists(path):
+        if self.stat_regular_file(path):
             file_size = f['file_size']
             
-            if requested_offset >= file_size:
-                return self.send_response(f"{self.response['ERROR']}{self.separator}Offset out of range")
-
-            self.send_response(f"{self.response['DOWNLOAD_READY']}{self.separator}{f['file_name']}{self.separator}{file_size}")
+            if requested_offset < 0 or requested_offset >= file_size:
+                return self.send_error("Offset out of range")
 
-            with open(path, "rb") as src:
-                src.seek(requested_offset)
-                
-                while True:
-                    chunk = src.read(self.buffer_size)
-                    if not chunk:
-                        break
-                    self.client_socket.sendall(chunk)
+            # Cork so the header record and the first data records leave as full segments
+            self.set_tcp_cork(True)
+            try:
+                self.send_response(b"%s%s%s%s%d" % (self.response_b['DOWNLOAD_READY'], self.separator_b,
+                                                    f['file_name'].encode('utf-8'), self.separator_b, file_size))
+
+                with open(path, "rb", buffering=0) as src:
+                    self.advise_file(src, requested_offset, 'POSIX_FADV_SEQUENTIAL', 'POSIX_FADV_WILLNEED')
+                    self.send_file_range(src, requested_offset, file_size - requested_offset)
+                    if file_size >= self.drop_cache_min_size:
+                        self.advise_file(src, requested_offset, 'POSIX_FADV_DONTNEED')
+            finally:
+                self.set_tcp_cork(False)
         else:
-            self.send_response(self.response['FILE_NOT_FOUND'])
+            self.send_response(self.response_b['FILE_NOT_FOUND'])
         
     def handle_file_delete(self, file_id, is_admin_req):
-        f = self.db_manager.get_file_record(file_id=file_id)
+        # Owners may delete their own files; admins may delete public ones on an admin request
+        allow_public = self.user_role == 'admin' and is_admin_req
+        f, deleted = self.db_manager.delete_file_checked(file_id, self.user_id, allow_public)
+        if deleted is None:
+            response_key = 'ADMIN_DELETE_FAILED' if is_admin_req else 'DELETE_FAILED'
+            return self.send_response(self.response_b.get(response_key))
+
         if not f:
-            return self.send_response(self.response['FILE_NOT_FOUND'])
+            return self.send_response(self.response_b['FILE_NOT_FOUND'])
 
-        can_delete = False
-        
-        if f['owner_id'] == self.user_id:
-            can_delete = True
-        
-        elif self.user_role == 'admin' and is_admin_req and f.get('is_public'):
-            can_delete = True
-                
-        if not can_delete:
-            return self.send_response(self.response['PERMISSION_DENIED'])
+        if deleted is False:
+            return self.send_response(self.response_b['PERMISSION_DENIED'])
 
-        if self.db_manager.delete_file_record(file_id):
-            path = self.resolve_path(f)
-            if os.path.exists(path):
-                os.remove(path)
-            
-            response_key = 'ADMIN_DELETE_SUCCESS' if is_admin_req else 'DELETE_SUCCESS'
-            self.send_response(self.response.get(response_key))
-        else:
-            response_key = 'ADMIN_DELETE_FAILED' if is_admin_req else 'DELETE_FAILED'
-            self.send_response(self.response.get(response_key))
+        path = self.resolve_path(f)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        
+        response_key = 'ADMIN_DELETE_SUCCESS' if is_admin_req else 'DELETE_SUCCESS'
+        self.send_response(self.response_b.get(response_key))
 
     def handle_file_status_change(self, file_id, cmd, target_user=None):
         f = self.db_manager.get_file_record(file_id=file_id, owner_id=self.user_id)
         if not f: 
-            return self.send_response(self.response['FILE_NOT_FOUND'])
+            return self.send_response(self.response_b['FILE_NOT_FOUND'])
 
         if cmd == self.cmds['MAKE_SHARED_USER'] and target_user:
-            recipient = self.db_manager.get_user_record(username=target_user)
-            if not recipient:
-                return self.send_response(f"{self.response['ERROR']}{self.separator}Recipient not found.")
+            recipient_id = self.db_manager.get_user_id(target_user)
+            if recipient_id is None:
+                return self.send_error("Recipient not found.")
             
             old_path = self.resolve_path(f) 
             
             recipient_metadata = {
                 'file_name': f['file_name'],
                 'is_public': False,
-                'recipient_id': recipient['id'] 
+                'recipient_id': recipient_id 
             }
             new_path = self.resolve_path(recipient_metadata)
 
             try:
                 os.makedirs(os.path.dirname(new_path), exist_ok=True)
-                if os.path.exists(new_path):
-                    return self.send_response(f"{self.response['ERROR']}{self.separator}Conflict.")
-                
-                shutil.copy2(old_path, new_path)
-
-                self.db_manager.add_file_record(
+                # Exclusive create stands in for an exists() pre-check (and closes its race)
+                try:
+                    self.link_or_copy(old_path, new_path)
+                except FileExistsError:
+                    return self.send_error("Conflict.")
+
+                if not self.db_manager.share_file_record(
+                    file_id=file_id,
                     owner_id=self.user_id,
-                    file_name=f['file_name'], 
-                    file_size=f['file_size'], 
-                    is_public=False,
-                    recipient_id=None
-                )
+                    recipient_id=recipient_id,
+                    file_name=f['file_name'],
+                    file_size=f['file_size']
+                ):
+                    return self.send_error("Storage operation failed.")
 
-                self.db_manager.update_file_record(
-                    file_id=file_id, 
-                    owner_id=recipient['id'], 
-                    is_public=False, 
-                    recipient_id=recipient['id']
-                )
+                return self.send_response(self.response_b['USER_SHARED_SUCCESS'])
 
-                return self.send_response(self.response['USER_SHARED_SUCCESS'])
+            except Exception as e:
+                logger.error("Status change failed: %s", e)
+                return self.send_error("Storage operation failed.")
+
+        if cmd == self.cmds['MAKE_PUBLIC_USER']:
+            if f['is_public']:
+                return self.send_response(self.response_b['USER_PUBLIC_SUCCESS'])
+
+            old_path = self.resolve_path(f)
+            new_path = self.resolve_path({'file_name': f['file_name'], 'is_public': True})
+
+            try:
+                try:
+                    self.move_file(old_path, new_path)
+                except FileExistsError:
+                    return self.send_error("Conflict.")
+
+                if not self.db_manager.update_file_record(file_id=file_id, is_public=True):
+                    # Put the bytes back where the (still private) record points
+                    try:
+                        self.move_file(new_path, old_path)
+                    except OSError as e:
+                        logger.error("Could not restore %s after failed publish: %s", old_path, e)
+                    return self.send_error("Storage operation failed.")
+                return self.send_response(self.response_b['USER_PUBLIC_SUCCESS'])
 
             except Exception as e:
-                logging.error(f"Status change failed: {e}")
-                return self.send_response(f"{self.response['ERROR']}{self.separator}Storage operation failed.")
+                logger.error("Status change failed: %s", e)
+                return self.send_error("Storage operation failed.")
+
+        self.send_error("Malformed command.")
 
     def resolve_path(self, record):
         if record.get('is_public'):
-            return os.path.join(self.public_files_dir, record['file_name'])
+            return self.contained_path(self.public_files_dir, record['file_name'])
         if record.get('recipient_id'):
-            recipient = self.db_manager.get_user_record(user_id=record['recipient_id'])
-            recip_name = recipient['username'] if recipient else "unknown"
-            return os.path.join(self.shared_uploads_dir, recip_name, record['file_name'])
-        return os.path.join(self.upload_dir, self.username, record['file_name'])
+            # Records from get_file_record() already carry the joined recipient name
+            if 'recipient_username' in record:
+                recip_name = record['recipient_username'] or "unknown"
+            else:
+                recipient = self.db_manager.get_user_record(user_id=record['recipient_id'])
+                recip_name = recipient['username'] if recipient else "unknown"
+            return self.contained_path(self.shared_uploads_dir, recip_name, record['file_name'])
+        return self.contained_path(self.user_upload_dir, record['file_name'])
+
+    def contained_path(self, root, *parts):
+        # root is absolute; commonpath (unlike startswith) doesn't accept /srv/ab as inside /srv/a
+        path = os.path.normpath(os.path.join(root, *parts))
+        if os.path.commonpath((path, root)) != root:
+            raise ValueError("Path escapes storage directory.")
+        return path
+
+    def user_dir(self, username):
+        # A user's directory must be a direct child of the upload root
+        path = os.path.normpath(os.path.join(self.upload_dir, username))
+        if os.path.dirname(path) != self.upload_dir:
+            raise ValueError("Invalid username for storage path.")
+        return path
+
+    def send_file_range(self, src, offset, count):
+        # Plain sockets get os.sendfile() via socket.sendfile()
+        if not isinstance(self.client_socket, ssl.SSLSocket):
+            return self.client_socket.sendfile(src, offset, count)
+
+        # TLS has to encrypt in user space; send slices of a read-only mapping rather than
+        # read() copies (SSLSocket.sendfile() would read() 8 KiB at a time)
+        try:
+            mapped = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return self.client_socket.sendfile(src, offset, count)
+
+        with mapped:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            end = min(offset + count, len(mapped))
+            with memoryview(mapped) as view:
+                for start in range(offset, end, self.buffer_size):
+                    self.client_socket.sendall(view[start:min(start + self.buffer_size, end)])
+        return max(0, end - offset)
+
+    def link_or_copy(self, src_path, dst_path):
+        # Same filesystem: a hardlink costs one metadata update instead of a byte copy
+        if self.use_hardlinks:
+            try:
+                os.link(src_path, dst_path)
+                return
+            except FileExistsError:
+                raise
+            except OSError as e:
+                logger.debug("Hardlink failed for %s, copying instead: %s", src_path, e)
+        self.copy_file(src_path, dst_path)
+
+    def move_file(self, src_path, dst_path):
+        # link + unlink renames in O(1) like os.rename, but refuses to replace an existing target;
+        # across filesystems (EXDEV) it degrades to a kernel-side copy
+        try:
+            os.link(src_path, dst_path)
+        except FileExistsError:
+            raise
+        except OSError as e:
+            logger.debug("Hardlink failed for %s, copying instead: %s", src_path, e)
+            self.copy_file(src_path, dst_path)
+        os.unlink(src_path)
+
+    def copy_file(self, src_path, dst_path):
+        # Reflink clone first, then kernel-side copy; shutil only when copy_file_range is unavailable
+        if hasattr(os, 'copy_file_range'):
+            try:
+                with open(src_path, 'rb') as src, open(dst_path, 'xb') as dst:
+                    if not self.reflink(src, dst):
+                        remaining = os.fstat(src.fileno()).st_size
+                        while remaining > 0:
+                            copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                            if copied == 0:
+                                break
+                            remaining -= copied
+                shutil.copystat(src_path, dst_path)
+                return
+            except FileExistsError:
+                raise
+            except OSError as e:
+                logger.debug("copy_file_range failed for %s, falling back to shutil: %s", src_path, e)
+        else:
+            # Claim the name exclusively before copy2 overwrites it
+            open(dst_path, 'xb').close()
+        shutil.copy2(src_path, dst_path)
+
+    def reflink(self, src, dst):
+        # FICLONE shares extents on Btrfs/XFS; other filesystems reject it and we copy instead
+        if fcntl is None:
+            return False
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            return False
+
+    def stat_regular_file(self, path):
+        # Single stat() standing in for exists()/isfile()/getsize(); None if missing or not a file
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return st if stat.S_ISREG(st.st_mode) else None
+
+    def advise_file(self, file_obj, offset, *advice_names):
+        # Page-cache hints for sequential transfers; no-op where posix_fadvise is missing
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        for name in advice_names:
+            try:
+                os.posix_fadvise(file_obj.fileno(), offset, 0, getattr(os, name))
+            except (AttributeError, OSError) as e:
+                logger.debug("[%s] posix_fadvise(%s) failed: %s", self.address, name, e)
+
+    def configure_socket(self):
+        # Small command responses must not wait behind Nagle; bulk sends are corked instead
+        try:
+            self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            logger.debug("[%s] Could not set TCP_NODELAY: %s", self.address, e)
+        self.set_quickack()
+
+        # Larger kernel buffers for high bandwidth-delay links; 0 keeps the OS defaults/autotuning
+        if self.socket_buffer_size <= 0:
+            return
+        for option, force_option in ((socket.SO_SNDBUF, 'SO_SNDBUFFORCE'), (socket.SO_RCVBUF, 'SO_RCVBUFFORCE')):
+            try:
+                # The *FORCE variants bypass net.core.[rw]mem_max but need CAP_NET_ADMIN
+                force = getattr(socket, force_option, None)
+                if force is not None:
+                    try:
+                        self.client_socket.setsockopt(socket.SOL_SOCKET, force, self.socket_buffer_size)
+                        continue
+                    except OSError:
+                        pass
+                self.client_socket.setsockopt(socket.SOL_SOCKET, option, self.socket_buffer_size)
+            except OSError as e:
+                logger.debug("[%s] Could not set socket buffer size: %s", self.address, e)
+
+    def set_quickack(self):
+        # Linux only; the kernel falls back to delayed ACKs on its own, so the command reader re-arms it
+        if not hasattr(socket, 'TCP_QUICKACK'):
+            return
+        try:
+            self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        except OSError as e:
+            logger.debug("[%s] Could not set TCP_QUICKACK: %s", self.address, e)
+
+    def set_tcp_cork(self, enabled):
+        # TCP_CORK on Linux, TCP_NOPUSH on BSD/macOS; elsewhere data is sent as it comes
+        cork_option = getattr(socket, 'TCP_CORK', None) or getattr(socket, 'TCP_NOPUSH', None)
+        if cork_option is None:
+            return
+        try:
+            self.client_socket.setsockopt(socket.IPPROTO_TCP, cork_option, int(enabled))
+        except OSError as e:
+            logger.debug("[%s] Could not toggle TCP cork: %s", self.address, e)
+
+    def send_error(self, message):
+        self.send_response(self.response_b['ERROR'] + self.separator_b + message.encode('utf-8'))
 
     def send_response(self, response):
-        self.client_socket.sendall(f"{response}".encode('utf-8'))
+        if not isinstance(response, (bytes, bytearray)):
+            response = f"{response}".encode('utf-8')
+        self.client_socket.sendall(response)
 
     def cleanup(self):
         self.client_socket.close()
-        logging.info(f"[{self.address}] Connection closed.")
\ No newline at end of file
+        logger.info("[%s] Connection closed.", self.address)
\ No newline at end of file
@@ -1,12 +1,27 @@
 import pymysql.cursors
 import logging
-import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from pymysql.err import IntegrityError
 import threading
 import sys
 import os
+import time
 import configparser
-from pymysqlpool import ConnectionPool
+import contextlib
+import functools
+import hashlib
+import hmac
+from dbutils.pooled_db import PooledDB
+
+@functools.lru_cache(maxsize=None)
+def _filtered_sql(head, clauses, tail=""):
+    # Built once per combination of filters; callers pass a tuple of fixed clause strings
+    return head + "".join(f" AND {clause}" for clause in clauses) + tail
+
+@functools.lru_cache(maxsize=None)
+def _update_sql(table, columns, key):
+    return f"UPDATE {table} SET {', '.join(f'{column} = %s' for column in columns)} WHERE {key} = %s"
 
 class DatabaseManager:
     def __init__(self, db_config_parser):
@@ -18,24 +33,178 @@ class DatabaseManager:
             'cursorclass': pymysql.cursors.DictCursor,
         }
         self.db_pool = None
+
+        # New hashes are Argon2id (RFC 9106 low-memory profile by default); bcrypt rows still verify
+        # and are upgraded on the next successful login.
+        # Both libraries release the GIL, so hashes already run in parallel on pool threads;
+        # this only stops a login/register burst from taking every core (and ARGON2_MEMORY_KIB each) at once
+        self._hash_slots = threading.BoundedSemaphore(os.cpu_count() or 1)
+        # Raising any of these is picked up by needs_rehash() and rolled out as users log in
+        self.password_hasher = PasswordHasher(
+            time_cost=db_config_parser.getint('ARGON2_TIME_COST', fallback=3),
+            memory_cost=db_config_parser.getint('ARGON2_MEMORY_KIB', fallback=65536),
+            parallelism=db_config_parser.getint('ARGON2_PARALLELISM', fallback=4),
+        )
+        self._check_hash_cost()
+
+        # Recent successful verifications, keyed by an HMAC of (stored hash, password) under a
+        # per-process random key so the plaintext is never kept; 0 disables it
+        self.verify_cache_ttl = db_config_parser.getfloat('VERIFY_CACHE_TTL', fallback=30)
+        self.verify_cache_size = 1024
+        self._verify_key = os.urandom(32)
+        self._verified = {}
+        self._verified_lock = threading.Lock()
+
+        # Bumped on every write to the files table so callers can invalidate cached listings
+        self.files_version = 0
+        self._files_version_lock = threading.Lock()
+
+        # Short-lived cache for user lookups: {key: (expires_at, value)}; 0 disables it
+        self.user_cache_ttl = db_config_parser.getfloat('USER_CACHE_TTL', fallback=30)
+        self.user_cache_size = 1024
+        self._user_cache = {}
+        self._user_cache_lock = threading.Lock()
         
         try:
-            self.db_pool = ConnectionPool(
+            # blocking=True queues callers when every connection is busy instead of failing them
+            pool_size = db_config_parser.getint('POOL_SIZE', fallback=10)
+            self.db_pool = PooledDB(
+                creator=pymysql,
+                mincached=2,
+                maxcached=pool_size,
+                maxshared=0,
+                maxconnections=pool_size,
+                blocking=True,
+                # No COM_PING per checkout and no ROLLBACK per return: connections run autocommit and
+                # _txn() commits or rolls back itself; SteadyDB still reopens a dropped connection on error
+                ping=0,
+                reset=False,
                 autocommit=True,
                 charset='utf8mb4',
-                maxsize=10,
                 **self.db_config
             )
             logging.info("Database connection pool initialized.")
         except Exception as e:
-            logging.critical(f"Error initializing MySQL connection pool: {e}", exc_info=True)
+            logging.critical("Error initializing MySQL connection pool: %s", e, exc_info=True)
             sys.exit(1)
+
+        # Login/logout session writes are queued ({user_id: session_id}, latest wins) and
+        # flushed in one transaction per interval; nothing reads users.session_id on the
+        # request path, so a login needn't wait for it. 0 writes synchronously.
+        self.session_flush_interval = db_config_parser.getfloat('SESSION_FLUSH_INTERVAL', fallback=0.05)
+        self._pending_sessions = {}
+        self._pending_sessions_cond = threading.Condition()
+        self._closing = False
+        self._session_writer = None
+        if self.session_flush_interval > 0:
+            self._session_writer = threading.Thread(target=self._session_flush_loop, name='session-writer', daemon=True)
+            self._session_writer.start()
             
-    def create_files_table_if_not_exists(self):
-        with self.db_pool.get_connection() as conn:
-            with conn.cursor() as cursor:
-                try:
-                    create_table_sql = """
+    def _check_hash_cost(self):
+        # One timed hash at startup so a slow host shows up in the log
+        start = time.perf_counter()
+        # Kept as the stand-in hash that unknown usernames are checked against
+        self._dummy_hash = self.hash_password("hash-cost-check")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        logging.info("Argon2id (t=%s, m=%s KiB, p=%s) takes %.0f ms per hash on this host.",
+                     self.password_hasher.time_cost, self.password_hasher.memory_cost,
+                     self.password_hasher.parallelism, elapsed_ms)
+
+    @staticmethod
+    def is_legacy_hash(password_hash):
+        return password_hash.startswith('$2')
+
+    def hash_password(self, password):
+        with self._hash_slots:
+            return self.password_hasher.hash(password)
+
+    def verify_password(self, password, password_hash):
+        if self.verify_cache_ttl <= 0:
+            return self._verify_password(password, password_hash)
+
+        # The stored hash is part of the key, so a password change invalidates entries by itself
+        key = hmac.new(self._verify_key, password_hash.encode('utf-8') + b'\0' + password.encode('utf-8'),
+                       hashlib.sha256).digest()
+        now = time.monotonic()
+        with self._verified_lock:
+            expires = self._verified.get(key)
+        if expires and expires > now:
+            return True
+
+        if not self._verify_password(password, password_hash):
+            # Failures are never cached, so every wrong guess still pays the full hash
+            return False
+        with self._verified_lock:
+            if key not in self._verified and len(self._verified) >= self.verify_cache_size:
+                del self._verified[next(iter(self._verified))]
+            self._verified[key] = now + self.verify_cache_ttl
+        return True
+
+    def verify_dummy(self, password):
+        """
+        Spends one full verification for a login whose username doesn't exist, so a miss
+        takes as long as a wrong password and response time doesn't reveal valid usernames.
+        """
+        self._verify_password(password, self._dummy_hash)
+        return False
+
+    def _verify_password(self, password, password_hash):
+        with self._hash_slots:
+            if self.is_legacy_hash(password_hash):
+                # Only pre-Argon2 rows need bcrypt, so it's loaded on first use rather than at startup
+                import bcrypt
+                return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+            try:
+                return self.password_hasher.verify(password_hash, password)
+            except (VerificationError, InvalidHashError):
+                return False
+
+    def _cache_get(self, key):
+        with self._user_cache_lock:
+            entry = self._user_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def _cache_put(self, key, value):
+        # Misses aren't cached, so a freshly registered user is visible immediately
+        if value is None or self.user_cache_ttl <= 0:
+            return
+        with self._user_cache_lock:
+            if key not in self._user_cache and len(self._user_cache) >= self.user_cache_size:
+                # Dicts keep insertion order: drop the oldest entry
+                del self._user_cache[next(iter(self._user_cache))]
+            self._user_cache[key] = (time.monotonic() + self.user_cache_ttl, value)
+
+    def _invalidate_user(self, user_id):
+        with self._user_cache_lock:
+            stale = [key for key, (_, value) in self._user_cache.items()
+                     if (value if key[0] == 'uid' else value['id']) == user_id]
+            for key in stale:
+                del self._user_cache[key]
+
+    def needs_rehash(self, password_hash):
+        return self.is_legacy_hash(password_hash) or self.password_hasher.check_needs_rehash(password_hash)
+
+    def verify_and_upgrade(self, user_row, password):
+        """
+        Checks password against user_row and, when it matches but the stored hash is bcrypt or
+        uses older Argon2 parameters, stores a fresh hash. An upgrade failure never fails the login.
+        """
+        if not self.verify_password(password, user_row['password_hash']):
+            return False
+        try:
+            if self.needs_rehash(user_row['password_hash']):
+                self.update_user_record(user_row['id'], password=password)
+        except Exception as e:
+            logging.warning("Password rehash for user %s failed: %s", user_row['id'], e)
+        return True
+
+    def _bump_files_version(self):
+        with self._files_version_lock:
+            self.files_version += 1
+
+    FILES_TABLE_SQL = """
                     CREATE TABLE IF NOT EXISTS files (
                         file_id INT AUTO_INCREMENT PRIMARY KEY,
                         owner_id INT NOT NULL,
@@ -48,16 +217,8 @@ class DatabaseManager:
                         FOREIGN KEY (recipient_id) REFERENCES users(id)
                     )
                     """
-                    cursor.execute(create_table_sql)
-                    logging.info("Files database table ensured.")
-                except Exception as e:
-                    logging.critical(f"Error creating files table: {e}", exc_info=True)        
-            
-    def create_user_table_if_not_exists(self):
-        with self.db_pool.get_connection() as conn:
-            with conn.cursor() as cursor:
-                try:
-                    create_table_sql = """
+
+    USERS_TABLE_SQL = """
                     CREATE TABLE IF NOT EXISTS users (
                         id INT AUTO_INCREMENT PRIMARY KEY,
                         username VARCHAR(255) NOT NULL UNIQUE,
@@ -66,112 +227,186 @@ class DatabaseManager:
                         session_id VARCHAR(36) NULL
                     )
                     """
-                    cursor.execute(create_table_sql)
+
+    # Everything callers read from a files row; uploaded_at is never used
+    FILE_COLUMNS = "f.file_id, f.owner_id, f.file_name, f.file_size, f.is_public, f.recipient_id"
+
+    FILES_LIST_SQL = "SELECT file_id, file_name, file_size, owner_id FROM files WHERE 1=1"
+    # Join the recipient's name in so resolving a shared file's path needs no second lookup
+    FILE_RECORD_SQL = (f"SELECT {FILE_COLUMNS}, u.username AS recipient_username FROM files f "
+                       "LEFT JOIN users u ON u.id = f.recipient_id WHERE 1=1")
+
+    # Match the WHERE clauses of get_files()/get_file_record(): private and shared listings,
+    # and the by-name lookup done after every upload
+    FILES_INDEXES = {
+        'idx_files_owner': "(owner_id, is_public, recipient_id)",
+        'idx_files_recipient': "(recipient_id, is_public)",
+        'idx_files_owner_name': "(owner_id, file_name)",
+    }
+
+    def ensure_schema(self):
+        # Both tables on one pooled connection and cursor; users first since files references it
+        with self.db_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                try:
+                    cursor.execute(self.USERS_TABLE_SQL)
                     logging.info("User database table ensured in 'ftp_users'.")
+                    cursor.execute(self.FILES_TABLE_SQL)
+                    logging.info("Files database table ensured.")
+                    self._ensure_file_indexes(cursor)
                 except Exception as e:
-                    logging.critical(f"Error creating user table: {e}", exc_info=True)
+                    logging.critical("Error creating database tables: %s", e, exc_info=True)
+
+    def _ensure_file_indexes(self, cursor):
+        # CREATE TABLE IF NOT EXISTS leaves existing tables alone, so add any missing index in one ALTER
+        cursor.execute(
+            "SELECT DISTINCT index_name AS name FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND table_name = 'files'"
+        )
+        existing = {row['name'] for row in cursor.fetchall()}
+        missing = [f"ADD INDEX {name} {columns}" for name, columns in self.FILES_INDEXES.items() if name not in existing]
+        if missing:
+            cursor.execute(f"ALTER TABLE files {', '.join(missing)}")
+            logging.info("Added files table indexes: %s", len(missing))
 
     def create_user(self, username, password, role='user'):
-        with self.db_pool.get_connection() as conn:
+        # Cheap existence probe first: a taken name shouldn't cost a full hash before the INSERT fails
+        if self.get_user_id(username) is not None:
+            logging.warning("User account creation failed: Username '%s' already exists.", username)
+            return False
+        # Hash before checking out a connection so the pool isn't held for the whole hash
+        password_hash = self.hash_password(password)
+        with self.db_pool.connection() as conn:
             with conn.cursor() as cursor:
                 try:
-                    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
                     cursor.execute("INSERT INTO users (username, password_hash, role) VALUES (%s, %s, %s)", (username, password_hash, role))
                     return True
                 except IntegrityError:
-                    logging.warning(f"User account creation failed: Username '{username}' already exists.")
+                    logging.warning("User account creation failed: Username '%s' already exists.", username)
                     return False
                 except pymysql.Error as e:
-                    logging.error(f"Error creating user '{username}': {e}", exc_info=True)
+                    logging.error("Error creating user '%s': %s", username, e, exc_info=True)
                     return False             
     
-    def get_user_record(self, user_id=None, username=None):
-        with self.db_pool.get_connection() as conn:
+    def get_user_record(self, user_id=None, username=None, with_password=False):
+        # password_hash is only selected for the login check
+        columns = "id, username, role, session_id"
+        if with_password:
+            columns += ", password_hash"
+        key = ('id', user_id, with_password) if user_id else ('name', username, with_password)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return dict(cached)
+
+        with self.db_pool.connection() as conn:
             with conn.cursor() as cursor:
                 try:
                     if user_id:
-                        query = f"SELECT * FROM users WHERE id = %s"
+                        query = f"SELECT {columns} FROM users WHERE id = %s LIMIT 1"
                         params = (user_id,)
                     elif username:
-                        query = f"SELECT * FROM users WHERE username = %s"
+                        query = f"SELECT {columns} FROM users WHERE username = %s LIMIT 1"
                         params = (username,)
                     else:
                         return None
                 
                     cursor.execute(query, params)
-                    return cursor.fetchone()
+                    record = cursor.fetchone()
+                    self._cache_put(key, record)
+                    return dict(record) if record else None
                 except pymysql.Error as e:
-                    logging.error(f"Error fetching user record: {e}")
+                    logging.error("Error fetching user record: %s", e)
                     return None      
     
     def add_file_record(self, owner_id, file_name, file_size, is_public=False, recipient_id=None):
-        with self.db_pool.get_connection() as conn:
+        with self.db_pool.connection() as conn:
             with conn.cursor() as cursor:
                 try:
                     sql = """
                         INSERT INTO files (owner_id, file_name, file_size, is_public, recipient_id)
                         VALUES (%s, %s, %s, %s, %s)
                     """
-                    cursor.execute(sql, (owner_id, file_name, file_size , is_public, recipient_id))
-                    logging.info(f"File record for '{file_name}' added (Public: {is_public}.")
+                    cursor.execute(sql, (owner_id, file_name, file_size, is_public, recipient_id))
+                    self._bump_files_version()
+                    logging.info("File record for '%s' added (Public: %s).", file_name, is_public)
                     return True
                 except Exception as e:
-                    logging.error(f"Failed to add file record for {file_name}: {e}.")
+                    logging.error("Failed to add file record for %s: %s.", file_name, e)
                     return False
                 
+    def get_user_id(self, username):
+        cached = self._cache_get(('uid', username))
+        if cached is not None:
+            return cached
+
+        # Plain tuple cursor: one column doesn't need a dict built per row
+        with self.db_pool.connection() as conn:
+            with conn.cursor(pymysql.cursors.Cursor) as cursor:
+                try:
+                    cursor.execute("SELECT id FROM users WHERE username = %s LIMIT 1", (username,))
+                    row = cursor.fetchone()
+                    user_id = row[0] if row else None
+                    self._cache_put(('uid', username), user_id)
+                    return user_id
+                except pymysql.Error as e:
+                    logging.error("Error fetching user id: %s", e)
+                    return None
+
     def get_files(self, owner_id=None, is_public=None, recipient_id=None, exclude_recipient=False):
-        with self.db_pool.get_connection() as conn:
-            with conn.cursor() as cursor:
+        """Returns (file_id, file_name, file_size, owner_id) tuples."""
+        with self.db_pool.connection() as conn:
+            with conn.cursor(pymysql.cursors.Cursor) as cursor:
                 try:
-                    query = "SELECT file_id, file_name, file_size, owner_id FROM files WHERE 1=1"
+                    clauses = []
                     params = []
 
                     if owner_id is not None:
-                        query += " AND owner_id = %s"
+                        clauses.append("owner_id = %s")
                         params.append(owner_id)
 
                     if recipient_id is not None:
-                        query += " AND recipient_id = %s"
+                        clauses.append("recipient_id = %s")
                         params.append(recipient_id)
                     elif exclude_recipient: 
-                        query += " AND recipient_id IS NULL"
+                        clauses.append("recipient_id IS NULL")
 
                     if is_public is not None:
-                        query += " AND is_public = %s"
+                        clauses.append("is_public = %s")
                         params.append(is_public)
 
-                    cursor.execute(query, tuple(params))
+                    cursor.execute(_filtered_sql(self.FILES_LIST_SQL, tuple(clauses)), tuple(params))
                     return cursor.fetchall()
                 except Exception as e:
-                    logging.error(f"Failed to get file list: {e}")
+                    logging.error("Failed to get file list: %s", e)
                     return []
         
     def get_file_record(self, file_id=None, file_name=None, owner_id=None, recipient_id=None, is_public=None):
-        with self.db_pool.get_connection() as conn:
+        with self.db_pool.connection() as conn:
             with conn.cursor() as cursor:
                 try:
-                    query = "SELECT * FROM files WHERE 1=1"
+                    clauses = []
                     params = []
                     if file_id:
-                        query += " AND file_id = %s"
+                        clauses.append("f.file_id = %s")
                         params.append(file_id)
                     if file_name:
-                        query += " AND file_name = %s"
+                        clauses.append("f.file_name = %s")
                         params.append(file_name)
                     if owner_id:
-                        query += " AND owner_id = %s"
+                        clauses.append("f.owner_id = %s")
                         params.append(owner_id)
                     if recipient_id:
-                        query += " AND recipient_id = %s"
+                        clauses.append("f.recipient_id = %s")
                         params.append(recipient_id)
                     if is_public is not None:
-                        query += " AND is_public = %s"
+                        clauses.append("f.is_public = %s")
                         params.append(is_public)
                     
-                    cursor.execute(query, tuple(params))
+                    # Callers take the first match only, so let the server stop there too
+                    cursor.execute(_filtered_sql(self.FILE_RECORD_SQL, tuple(clauses), " LIMIT 1"), tuple(params))
                     return cursor.fetchone()
                 except pymysql.Error as e:
-                    logging.error(f"Error fecthing file record: {e}")
+                    logging.error("Error fecthing file record: %s", e)
                     return None                   
     
     def update_file_record(self, file_id, owner_id=None, is_public=None, recipient_id=None):
@@ -179,97 +414,206 @@ class DatabaseManager:
         params = []
 
         if is_public is not None:
-            updates.append("is_public = %s")
+            updates.append("is_public")
             params.append(is_public)
         
         # Allow recipient_id to be updated independently
         if recipient_id is not None:
-            updates.append("recipient_id = %s")
+            updates.append("recipient_id")
             params.append(recipient_id)
             
         if owner_id is not None:
-            updates.append("owner_id = %s")
+            updates.append("owner_id")
             params.append(owner_id)    
 
         if not updates:
             return False
 
-        with self.db_pool.get_connection() as conn:
+        with self.db_pool.connection() as conn:
             with conn.cursor() as cursor:
                 try:
-                    sql = f"UPDATE files SET {', '.join(updates)} WHERE file_id = %s"
                     params.append(file_id)
-                    cursor.execute(sql, tuple(params))
+                    cursor.execute(_update_sql('files', tuple(updates), 'file_id'), tuple(params))
+                    self._bump_files_version()
                     return cursor.rowcount > 0
                 except Exception as e:
-                    logging.error(f"Database error updating file {file_id}: {e}")
+                    logging.error("Database error updating file %s: %s", file_id, e)
                     return False
                     
     def update_user_record(self, user_id, username=None, password=None, session_id=None):
         """
-        Generic user update. Dynamically builds the SET clause based on provided args.
+        Generic user update. The SET clause depends on which args are provided.
         Supports updating password (with hashing), and session_id.
         """
+        if session_id is not None and not username and not password:
+            return self.set_user_session(user_id, session_id)
+
         updates = []
         params = []
 
         if username:
-            updates.append("username = %s")
+            updates.append("username")
             params.append(username)
                 
         if password:
-            hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-            updates.append("password_hash = %s")
+            hashed = self.hash_password(password)
+            updates.append("password_hash")
             params.append(hashed)
         
         if session_id is not None:
-            updates.append("session_id = %s")
+            updates.append("session_id")
             params.append(session_id)
 
         if not updates:
             return False
 
-        sql = f"UPDATE users SET {', '.join(updates)} WHERE id = %s"
+        sql = _update_sql('users', tuple(updates), 'id')
         params.append(user_id)
 
         try:
-            with self.db_pool.get_connection() as conn:
+            with self.db_pool.connection() as conn:
                 with conn.cursor() as cursor:
                     cursor.execute(sql, tuple(params))
+                    self._invalidate_user(user_id)
                     return cursor.rowcount > 0
         except Exception as e:
-            logging.error(f"Database error updating user {user_id}: {e}")
+            logging.error("Database error updating user %s: %s", user_id, e)
             return False
     
-    def delete_file_record(self, file_id, owner_id=None):
-        with self.db_pool.get_connection() as conn:
+    def set_user_session(self, user_id, session_id):
+        """
+        Session write for login/logout (session_id=None clears it). Queued for the
+        background writer unless SESSION_FLUSH_INTERVAL is 0. When queued, True only means
+        the write was accepted into the queue; failed batches are requeued and retried by
+        the writer. In synchronous mode it reports whether the UPDATE matched a row.
+        """
+        if self.session_flush_interval > 0:
+            with self._pending_sessions_cond:
+                self._pending_sessions[user_id] = session_id
+                self._pending_sessions_cond.notify()
+            return True
+        try:
+            with self.db_pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("UPDATE users SET session_id = %s WHERE id = %s", (session_id, user_id))
+                    self._invalidate_user(user_id)
+                    return cursor.rowcount > 0
+        except Exception as e:
+            logging.error("Database error updating session for user %s: %s", user_id, e)
+            return False
+
+    def _session_flush_loop(self):
+        cond = self._pending_sessions_cond
+        while True:
+            with cond:
+                while not self._pending_sessions and not self._closing:
+                    cond.wait()
+                # Let a burst of logins accumulate into one batch; close_pool() cuts the wait short
+                cond.wait_for(lambda: self._closing, timeout=self.session_flush_interval)
+                closing = self._closing
+            if not self.flush_sessions() and not closing:
+                # Database unavailable: back off instead of retrying every interval
+                with cond:
+                    cond.wait_for(lambda: self._closing, timeout=max(1.0, self.session_flush_interval))
+            if closing:
+                return
+
+    def flush_sessions(self):
+        """Writes every queued session change in one transaction; returns False if it failed."""
+        with self._pending_sessions_cond:
+            batch, self._pending_sessions = self._pending_sessions, {}
+        if not batch:
+            return True
+        try:
+            with self._txn() as (conn, cursor):
+                cursor.executemany("UPDATE users SET session_id = %s WHERE id = %s",
+                                   [(session_id, user_id) for user_id, session_id in batch.items()])
+        except Exception as e:
+            logging.error("Database error writing %s session update(s); will retry: %s", len(batch), e)
+            # Requeue, but never over a newer value queued for the same user meanwhile
+            with self._pending_sessions_cond:
+                for user_id, session_id in batch.items():
+                    self._pending_sessions.setdefault(user_id, session_id)
+            return False
+        for user_id in batch:
+            self._invalidate_user(user_id)
+        return True
+
+    @contextlib.contextmanager
+    def _txn(self):
+        """Yields (conn, cursor) on one pooled connection inside BEGIN ... COMMIT; rolls back on error."""
+        with self.db_pool.connection() as conn:
             with conn.cursor() as cursor:
+                conn.begin()
                 try:
-                    query = "DELETE FROM files WHERE file_id = %s"
-                    params = [file_id]
-                    
-                    if owner_id:
-                        query += " AND owner_id = %s"
-                        params.append(owner_id)
-                        
-                    cursor.execute(query, tuple(params))
-                    success = cursor.rowcount == 1
-                    
-                    if success:
-                        logging.info(f"Successfully delete file record with ID {file_id}.")
-                    else:
-                        logging.warning(f"Delete attempted for file ID {file_id}, but no record was matched.")
-                    return success
-                                
-                except Exception as e:
-                    logging.error(f"Database error during file deletion (ID: {file_id}): {e}")
-                    return False
-                
+                    yield conn, cursor
+                except BaseException:
+                    conn.rollback()
+                    raise
+                conn.commit()
+
+    def delete_file_checked(self, file_id, user_id, allow_public=False):
+        """
+        Locks, permission-checks and deletes a file row in one transaction, so no other
+        request can change or delete it between the check and the DELETE.
+        Returns (record, deleted): record is None if there is no such file; deleted is
+        True on success, False if user_id may not delete it, None on a database error.
+        """
+        record = None
+        try:
+            with self._txn() as (conn, cursor):
+                cursor.execute(self.FILE_RECORD_SQL + " AND f.file_id = %s FOR UPDATE", (file_id,))
+                record = cursor.fetchone()
+                if not record:
+                    return None, False
+                if record['owner_id'] != user_id and not (allow_public and record['is_public']):
+                    return record, False
+                cursor.execute("DELETE FROM files WHERE file_id = %s", (file_id,))
+        except Exception as e:
+            logging.error("Database error during file deletion (ID: %s): %s", file_id, e)
+            return record, None
+
+        self._bump_files_version()
+        logging.info("Successfully delete file record with ID %s.", file_id)
+        return record, True
+
+    def share_file_record(self, file_id, owner_id, recipient_id, file_name, file_size):
+        """
+        Hands file_id over to recipient_id and records the owner's private copy, both in one
+        transaction so a failure can't leave only half of the share in the table.
+        """
+        try:
+            with self._txn() as (conn, cursor):
+                cursor.execute(
+                    "INSERT INTO files (owner_id, file_name, file_size, is_public, recipient_id) "
+                    "VALUES (%s, %s, %s, FALSE, NULL)",
+                    (owner_id, file_name, file_size)
+                )
+                cursor.execute(
+                    "UPDATE files SET owner_id = %s, is_public = FALSE, recipient_id = %s WHERE file_id = %s",
+                    (recipient_id, recipient_id, file_id)
+                )
+        except Exception as e:
+            logging.error("Database error sharing file %s: %s", file_id, e)
+            return False
+
+        self._bump_files_version()
+        return True
+
     def close_pool(self):
         """Manually dispose all connections in the pool"""
         if self.db_pool:
+            with self._pending_sessions_cond:
+                self._closing = True
+                self._pending_sessions_cond.notify()
+            # The writer does the final flush itself; wait for it so the pool isn't closed under it
+            if self._session_writer:
+                self._session_writer.join()
+            else:
+                self.flush_sessions()
             try:     
+                self.db_pool.close()
                 self.db_pool = None           
                 logging.info("Database connection pool disposed.")
             except Exception as e:
-                logging.error(f"Error disposing connection pool: {e}")
\ No newline at end of file
+                logging.error("Error disposing connection pool: %s", e)
\ No newline at end of file